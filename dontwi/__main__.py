@@ -6,7 +6,6 @@ import os
 import json
 from argparse import SUPPRESS, ArgumentParser
 from pprint import pprint
-from itertools import tee
 from dontwi.config import Config
 from dontwi._dontwi import Dontwi
 from dontwi.status_text import StatusText
@@ -14,14 +13,23 @@ from dontwi.result_log import ResultLog
 from dontwi.version import __version__
 
 
-def show_log_db_summary(conf):
+def show_log_db_summary(conf, is_verify=False):
     result_log = ResultLog(conf.items)
+    if is_verify:
+        drifts = result_log.verify_result_counters()
+        for result_status, (saved_count, actual_count) in sorted(drifts.items()):
+            print("drift\t{0}\t{1}\t{2}".format(
+                result_status, saved_count, actual_count))
     print("dontwi version\t{0}".format(__version__))
     print("log db\t{0}".format(result_log.get_info()))
     print('record number\t{0}'.format(result_log.get_record_number()))
+    counters = result_log.get_result_counters()
     for result_status in ["Start", "Waiting", "Succeed", "Failed", "Test"]:
-        results = result_log.get_result_summaries_by_results([result_status])
-        print("{0}\t{1}".format(result_status, len(results)))
+        counter = counters.get(result_status, {"count": 0})
+        print("{0}\t{1}\t{2}\t{3}".format(
+            result_status, counter["count"],
+            counter.get("first_processed_at", ""),
+            counter.get("last_processed_at", "")))
 
 
 def dump_status_strings(conf):
@@ -32,16 +40,16 @@ def dump_status_strings(conf):
     [since, until, limit] = [
         dontwi.config.inbound.get(option, "")
         for option in ["since", "until", "limit"]]
-    statuses, statuses2 = tee(in_cn.get_statuses_by_hashtag(
-        hashtag=trigger_str, since=since, until=until, limit=limit))
     status_pr = StatusText(dontwi.config.outbound)
     result_log = ResultLog(dontwi.config.items)
+    statuses = result_log.filter_unprocessed(in_cn.get_statuses_by_hashtag(
+        hashtag=trigger_str, since=since, until=until, limit=limit))
     summaries = dontwi.summaries_to_be_listed(result_log=result_log,
                                               status_pr=status_pr,
                                               statuses=statuses,
                                               trigger_str=trigger_str)
     status_dc = {a_status.get_status_id(): a_status.status["content"]
-                 for a_status in statuses2}
+                 for a_status in statuses}
     dump_strs = ["{0}\n{1}\n{2}\n[{3}]".format(a_summary["inbound_status_id"], a_summary["status_string"],
                                                a_summary["inbound_status_url"], status_dc[a_summary["inbound_status_id"]])
                  for a_summary in summaries]
@@ -49,14 +57,23 @@ def dump_status_strings(conf):
         print(lint_str)
 
 
-def dump_log(conf):
+def dump_log(conf, filters):
+    result_log = ResultLog(conf.items)
+    for a_summary in result_log.iter_log(**filters):
+        print(json.dumps(dict(a_summary, eid=a_summary.eid)))
+
+
+def dump_log_readable(conf, filters):
     result_log = ResultLog(conf.items)
-    print(json.dumps(result_log.dump_log()))
+    for a_summary in result_log.iter_log(**filters):
+        pprint(dict(a_summary, eid=a_summary.eid))
 
 
-def dump_log_readable(conf):
+def compact_log(conf):
     result_log = ResultLog(conf.items)
-    pprint(result_log.dump_log())
+    archived_number = result_log.compact_log(
+        **result_log.get_compaction_options())
+    print("archived records\t{0}".format(archived_number))
 
 
 def remove_specified_summaries(conf, results):
@@ -96,12 +113,18 @@ def main():
     ar_prs.add_argument("--summary",
                         help="Showing summary of log DB",
                         action="store_true")
+    ar_prs.add_argument("--verify",
+                        help="Rebuilding result counters of log DB from all records " +
+                        "and showing the differences with --summary.",
+                        action="store_true")
     ar_prs.add_argument("--trigger",
                         help="Using TRIGGER instead of trigger in the config file")
     ar_prs.add_argument("--since",
-                        help="Using SINCE instead of since in the config file")
+                        help="Using SINCE instead of since in the config file. " +
+                        "With --dump-log, dumping only records processed since SINCE.")
     ar_prs.add_argument("--until",
-                        help="Using UNTIL instead of until in the config file")
+                        help="Using UNTIL instead of until in the config file. " +
+                        "With --dump-log, dumping only records processed before UNTIL.")
     ar_prs.add_argument("--limit",
                         help="Using LIMIT instead of limit in the config file")
     #ar_prs.add_argument("--save", help="", action='store_true')
@@ -117,10 +140,19 @@ def main():
                         help="Dumping status strings to be marked as 'Waiting' status",
                         action='store_true')
     ar_prs.add_argument("--dump-log",
-                        help="Dumping all records in the log database.",
+                        help="Dumping records in the log database as JSON lines.",
                         action='store_true')
     ar_prs.add_argument("--dump-log-readable",
-                        help="Dumping all records in the log database in a human-readable format.",
+                        help="Dumping records in the log database in a human-readable format.",
+                        action='store_true')
+    ar_prs.add_argument("--result",
+                        help="Dumping only records in RESULT with --dump-log. " +
+                        "It can be given more than once.",
+                        action='append')
+    ar_prs.add_argument("--hashtag",
+                        help="Dumping only records made for HASHTAG with --dump-log.")
+    ar_prs.add_argument("--compact-log",
+                        help="Moving old 'Succeed' and 'Test' records in the log database to compressed archives.",
                         action='store_true')
     ar_prs.add_argument("--remove-waiting",
                         help="Removing records in 'Waiting' from the database",
@@ -169,16 +201,22 @@ def main():
     #    conf.save()
     #    exit()
     if args.summary:
-        show_log_db_summary(conf)
+        show_log_db_summary(conf, args.verify)
         exit()
     if args.dump_status_strings:
         dump_status_strings(conf)
         exit()
+    # --since and --until filter records by their processed_at in dumping.
+    dump_filters = {"results": args.result, "since": args.since or "",
+                    "until": args.until or "", "hashtag": args.hashtag or ""}
     if args.dump_log:
-        dump_log(conf)
+        dump_log(conf, dump_filters)
         exit()
     if args.dump_log_readable:
-        dump_log_readable(conf)
+        dump_log_readable(conf, dump_filters)
+        exit()
+    if args.compact_log:
+        compact_log(conf)
         exit()
     if args.remove_waiting:
         remove_waiting_result_summaries(conf)
@@ -6,6 +6,7 @@ import json
 import os
 import re
 import copy
+import threading
 from logging import StreamHandler, getLogger
 
 from twython import TwythonError, TwythonRateLimitError
@@ -57,20 +58,20 @@ class Dontwi(object):
     def summaries_to_be_listed(
             result_log, status_pr, statuses, trigger_str):
         summaries = []
-        for a_status in statuses:
-            # results's 2nd.  condition which match to "Start" is for
-            # fail-safe.
-            if not result_log.has_result_of_status(
-                    status=a_status, results=["Succeed", "Start", "Failed", "Test"]):
-                st_str = status_pr.make_tweet_string_from_toot(
-                    a_status, hashtag=trigger_str)
-
-                rs_str = "Waiting"
-                rs_sm = result_log.make_result_and_others_summary(
-                    status_string=st_str, hashtag=trigger_str, result=rs_str)
-                in_sm = result_log.make_status_summary("inbound", a_status)
-                rs_sm.update(in_sm)
-                summaries.append(rs_sm)
+        # results's 2nd.  condition which match to "Start" is for
+        # fail-safe.
+        unprocessed_statuses = result_log.filter_unprocessed(
+            statuses, results=["Succeed", "Start", "Failed", "Test"])
+        for a_status in unprocessed_statuses:
+            st_str = status_pr.make_tweet_string_from_toot(
+                a_status, hashtag=trigger_str)
+
+            rs_str = "Waiting"
+            rs_sm = result_log.make_result_and_others_summary(
+                status_string=st_str, hashtag=trigger_str, result=rs_str)
+            in_sm = result_log.make_status_summary("inbound", a_status)
+            rs_sm.update(in_sm)
+            summaries.append(rs_sm)
         return summaries
 
     def fill_in_waiting_list(
@@ -84,10 +85,15 @@ class Dontwi(object):
 
     def process_one_waiting_status(self, result_log, result_summary, media_ios, out_cn,
                                    is_dry_run):
-        result_summary["result"] = "Start"
-        result_summary.update(result_log.get_processed_at_dict())
-        [result_summary_eid] = result_log.update_result_summary_in_db(
-            result_summary=result_summary, eids=[result_summary.eid])
+        # The "Start" mark is written before posting as fail-safe against
+        # double posting. The other transitions are written after posting
+        # in one session, so that no session is held while posting.
+        if result_summary["result"] != "Start":
+            result_summary["result"] = "Start"
+            result_summary.update(result_log.get_lease_dict())
+            result_log.update_result_summary_in_db(
+                result_summary=result_summary, eids=[result_summary.eid])
+        result_summary_eid = result_summary.eid
         out_status = None
         result_summaries = [(result_summary, result_summary_eid)]
         
@@ -144,6 +150,10 @@ class Dontwi(object):
         finally:
             pass
 
+        with result_log.session():
+            return self.__save_result_summaries(result_log, result_summaries)
+
+    def __save_result_summaries(self, result_log, result_summaries):
         for a_result_summary, a_eid in result_summaries:        
             if a_eid:
                 [updated_eid] = result_log.update_result_summary_in_db(
@@ -159,49 +169,63 @@ class Dontwi(object):
             self.logger.info(self.message_to_logger(result_summary=a_result_summary))
         return False
 
-    def run(self, is_dry_run=True):
-        operation_cf = self.config.items["operation"]
+    def run(self, is_dry_run=True, workers=1):
+        """Transports one waiting status in each of workers threads.
+        The waiting list is filled in from inbound when it is empty."""
         result_log = ResultLog(self.config.items)
+        if result_log.peek_waiting() is None:
+            in_cn = self.get_connector("inbound")
+            in_cn.connect()
+            trigger_str = self.get_trigger()
+            status_text = StatusText(self.config.outbound)
+            statuses = in_cn.get_statuses_by_hashtag(hashtag=trigger_str, since=self.config.inbound.get("since", ""),
+                                                     until=self.config.inbound.get(
+                "until", ""),
+                limit=self.config.inbound.get("limit", ""))
+            eids = self.fill_in_waiting_list(
+                result_log, status_text, statuses, trigger_str)
+            if not eids:
+                return False
+        worker_results = [True] * workers
+
+        def work(number):
+            # Each worker has its own log DB connection.
+            worker_log = result_log if number == 0\
+                else ResultLog(self.config.items)
+            worker_results[number] = self.__run(worker_log, is_dry_run)
+
+        threads = [threading.Thread(target=work, args=(a_number,))
+                   for a_number in range(1, workers)]
+        for a_thread in threads:
+            a_thread.start()
+        work(0)
+        for a_thread in threads:
+            a_thread.join()
+        result_log.compact_log_if_due()
+        return any(worker_results)
+
+    def __run(self, result_log, is_dry_run):
+        target = result_log.dequeue_waiting()
+        if target is None:
+            # Other workers have claimed all waiting statuses.
+            return False
         out_cn = self.get_connector("outbound")
-        for counter in range(2):
-            waiting_result_summaries\
-                = result_log.get_result_summaries_by_results(["Waiting"])
-            if waiting_result_summaries:
-                target = waiting_result_summaries[0]
-                media_dicts = target["inbound_medias"]\
-                    if "inbound_medias" in target else []
-                try:
-                    media_ios = []
-                    if media_dicts:
-                        if not 'in_cn' in locals():
-                            in_cn = self.get_connector("inbound")
-                            in_cn.connect()
-                        media_ios = in_cn.get_media_ios(media_dicts)
-                    self.process_one_waiting_status(result_log=result_log,
-                                                    result_summary=target,
-                                                    media_ios=media_ios,
-                                                    out_cn=out_cn, is_dry_run=is_dry_run)
-                    return False
-                finally:
-                    for a_io in media_ios:
-                        a_io.io.close()
-                return True
-            else:
-                if counter == 0:
-                    in_cn = self.get_connector("inbound")
-                    in_cn.connect()
-                    trigger_str = self.get_trigger()
-                    status_text = StatusText(self.config.outbound)
-                    statuses = in_cn.get_statuses_by_hashtag(hashtag=trigger_str, since=self.config.inbound.get("since", ""),
-                                                             until=self.config.inbound.get(
-                        "until", ""),
-                        limit=self.config.inbound.get("limit", ""))
-                    eids = self.fill_in_waiting_list(
-                        result_log, status_text, statuses, trigger_str)
-                    if not eids:
-                        return False
-        self.logger.warning("Something wrong in waiting list process!")
-        return True
+        media_dicts = target["inbound_medias"]\
+            if "inbound_medias" in target else []
+        try:
+            media_ios = []
+            if media_dicts:
+                in_cn = self.get_connector("inbound")
+                in_cn.connect()
+                media_ios = in_cn.get_media_ios(media_dicts)
+            self.process_one_waiting_status(result_log=result_log,
+                                            result_summary=target,
+                                            media_ios=media_ios,
+                                            out_cn=out_cn, is_dry_run=is_dry_run)
+            return False
+        finally:
+            for a_io in media_ios:
+                a_io.io.close()
 
     def get_connector(self, dir_str):
         endpoint = self.config.inbound if dir_str == "inbound"\
@@ -23,6 +23,11 @@ class DontwiMediaError(IOError):
     """
     pass
 
+class DontwiResultLogError(IOError):
+    """Raised when the log DB can not be read.
+    """
+    pass
+
 class StatusTextError(AttributeError):
     """Raised when processing error occurred.
     """
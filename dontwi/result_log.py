@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 """Result log manager
 """
-from datetime import datetime, timezone
-from functools import reduce
-from operator import and_, or_
+import gzip
+import json
+import os
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
 
+from dateutil.parser import parse
 from packaging import version
-from tinydb import Query, TinyDB
 
+from .exception import DontwiConfigError
+from .result_store import (JournalResultStore, SqliteResultStore,
+                           TinyDBResultStore)
 from .version import __version__
 
 
@@ -17,103 +23,377 @@ class ResultLog(object):
     def __init__(self, config):
         self.items = config
         self.file_name = self.items["result log"]["db_file"]
-        with TinyDB(self.file_name) as db_entity:
-            if not db_entity:
-                self.__set_info(db_entity)
+        self.store = self.get_store()
+        with self.session():
+            app_info = self.store.get_info_item('application', 'dontwi')
+            version_str = app_info['version'] if app_info else '0'
+            # Records have to be in the queue and history tables before
+            # the other migrations, which access them through the store.
+            if version.parse(version_str) < version.parse('1.2'):
+                self.migrate_to_1_2()
+            if not self.store.count():
+                self.__set_info()
             else:
-                info_table = self.__get_info_table(db_entity)
-                app_info = self.__get_info_from_table(info_table)
-                version_str = app_info[0]['version'] if app_info else '0'
                 if version.parse(version_str) < version.parse('1.0'):
-                    self.migrate_to_1_0(db_entity)
-                if version.parse(version_str) < version.parse('1.1'):
-                    self.__set_info(db_entity)
+                    self.migrate_to_1_0()
+                if version.parse(version_str) < version.parse('1.2'):
+                    self.__set_info()
+            self.store.check_index()
+            if self.store.get_info_item('name', 'result_counters') is None:
+                self.verify_result_counters()
 
-    @staticmethod
-    def __get_info_table(db_entity):
-        info_table = db_entity.table('info')
-        return info_table
+    def get_store(self):
+        backend = self.items["result log"].get("backend", "tinydb")
+        if backend in ["tinydb", ""]:
+            return TinyDBResultStore(self.file_name)
+        elif backend == "sqlite":
+            return SqliteResultStore(self.file_name)
+        elif backend == "journal":
+            return JournalResultStore(
+                self.file_name,
+                snapshot_interval=self.items["result log"].getint(
+                    "snapshot_interval", fallback=1000))
+        raise DontwiConfigError(
+            'Unknown result log backend \'{0}\''.format(backend))
 
-    @staticmethod
-    def __get_info_from_table(info_table):
-        app_info = info_table.search(Query().application == 'dontwi')
-        return app_info
-
-    def __set_info(self, db_entity):
-        info_table = self.__get_info_table(db_entity)
-        app_info = self.__get_info_from_table(info_table)
-        if not app_info:
-            info_table.insert(
-                {'application': 'dontwi', 'version': __version__})
-        else:
-            info_table.update({'version': __version__}, eids=[app_info[0].eid])
+    def session(self):
+        """Returns a context in which the log DB is loaded once and all
+        changes are written at the end of it in one go.
+
+        Changes are discarded when the block raises an exception.
+        Nested sessions share the outer one.
+        """
+        return self.store.session()
+
+    def commit(self):
+        """Writes changes made so far in the current session."""
+        self.store.commit()
+
+    def close(self):
+        self.store.close()
+
+    def __set_info(self):
+        self.store.set_info_item(
+            'application', 'dontwi', {'version': __version__})
 
     def get_info(self):
-        with TinyDB(self.file_name) as db_entity:
-            info_table = self.__get_info_table(db_entity)
-            app_info = self.__get_info_from_table(info_table)
-        return app_info[0]
+        return self.store.get_info_item('application', 'dontwi')
 
     def get_record_number(self):
-        with TinyDB(self.file_name) as db_entity:
-            return len(db_entity)
+        return self.store.count()
 
-    def migrate_to_1_0(self, db_entity):
-        for element in db_entity:
-            if isinstance(element['inbound_status_id'], int):
-                element['inbound_status_id'] = str(
-                    element['inbound_status_id'])
-                db_entity.update(element, eids=[element.eid])
-        self.__set_info(db_entity)
+    def migrate_to_1_0(self):
+        with self.session():
+            for element in self.store.all():
+                if isinstance(element['inbound_status_id'], int):
+                    self.store.update(
+                        {'inbound_status_id': str(element['inbound_status_id'])},
+                        eids=[element.eid])
+            self.__set_info()
 
-    def has_result_of_status(self, status, results):
+    def migrate_to_1_2(self):
+        """Splits records into the queue table of Waiting and Start records
+        and the history table of finished records."""
+        self.store.split_tables()
+
+    def rebuild_index(self):
+        """Builds the (inbound, inbound_status_id) index from all records."""
+        return self.store.rebuild_index()
+
+    def __results_by_status(self, status_ids):
+        """Returns {status_id: [result]} of records and archived records."""
         inbound_str = self.items["operation"]["inbound"]
-        query = Query()
-        result_q = reduce(or_, [
-            query.result == a_result for a_result in results])
-        querys = [query.inbound == inbound_str,
-                  query.inbound_status_id == status.get_status_id(), result_q]
-        combined_query = reduce(and_, querys)
-        return self.search_db(combined_query)
+        status_ids = list(status_ids)
+        results_by_status = {
+            a_status_id: list(a_results.values())
+            for a_status_id, a_results in self.store.results_by_status(
+                inbound_str, status_ids).items()}
+        archived_results = self.store.archived_results(inbound_str, status_ids)
+        for a_status_id, a_result in archived_results.items():
+            results_by_status.setdefault(a_status_id, []).append(a_result)
+        return results_by_status
+
+    def has_result_of_status(self, status, results):
+        status_id = status.get_status_id()
+        status_results = self.__results_by_status([status_id]).get(status_id, [])
+        return any(a_result in results for a_result in status_results)
+
+    def filter_unprocessed(self, statuses,
+                           results=("Succeed", "Start", "Failed", "Test")):
+        """Returns statuses which have no record of the specified results."""
+        statuses = list(statuses)
+        results_by_status = self.__results_by_status(
+            [a_status.get_status_id() for a_status in statuses])
+        unprocessed = []
+        for a_status in statuses:
+            status_results = results_by_status.get(a_status.get_status_id(), [])
+            if not any(a_result in results for a_result in status_results):
+                unprocessed.append(a_status)
+        return unprocessed
 
     def get_result_summaries_by_status(self, status):
         inbound_str = self.items["operation"]["inbound"]
-        query = Query()
-        combined_query = (query.inbound == inbound_str) & (
-            query.inbound_status_id == status.get_status_id())
-        return self.search_db(combined_query)
+        status_id = status.get_status_id()
+        with self.session():
+            status_results = self.store.results_by_status(
+                inbound_str, [status_id]).get(status_id, {})
+            summaries = [self.store.get(a_eid) for a_eid in status_results]
+        return [a_summary for a_summary in summaries if a_summary is not None]
 
     def get_result_summaries_by_results(self, results):
-        query = Query()
-        querys = [query.result == a_result for a_result in results]
-        combined_query = reduce(or_, querys)
-        return self.search_db(combined_query)
+        return self.store.search_by_results(results)
+
+    def peek_waiting(self):
+        """Returns the 'Waiting' summary of the oldest inbound status."""
+        return self.store.first_waiting()
+
+    def dequeue_waiting(self):
+        """Claims the 'Waiting' summary of the oldest inbound status, and
+        marks it as 'Start' with a lease of this worker.
+        Returns None when nothing is waiting.
+
+        The claim is made in one session, so workers in other threads or
+        processes never claim the same summary. 'Start' summaries whose
+        lease has expired are put back to 'Waiting' beforehand.
+        """
+        with self.session():
+            self.requeue_expired_leases()
+            result_summary = self.store.first_waiting()
+            if result_summary is None:
+                return None
+            result_summary["result"] = "Start"
+            result_summary.update(self.get_lease_dict())
+            self.update_result_summary_in_db(
+                result_summary, eids=[result_summary.eid])
+            self.commit()
+        return result_summary
+
+    def get_lease_dict(self):
+        """Returns processed_at, lease_owner and lease_expires_at fields of a
+        summary claimed now by this worker."""
+        now = datetime.now(timezone.utc)
+        lease_seconds = self.items["result log"].getint(
+            "lease_seconds", fallback=600)
+        return {"processed_at": now.isoformat(),
+                "lease_owner": "{0}:{1}:{2}".format(
+                    socket.gethostname(), os.getpid(), threading.get_ident()),
+                "lease_expires_at": (
+                    now + timedelta(seconds=lease_seconds)).isoformat()}
 
-    def search_db(self, query):
-        with TinyDB(self.file_name) as db_entity:
-            summaries = db_entity.search(query)
-            return summaries
-        return None
+    def requeue_expired_leases(self):
+        """Puts 'Start' summaries whose lease has expired back to 'Waiting'.
+        'Start' summaries without a lease are left as fail-safe against
+        double posting. Returns their eids."""
+        now_str = datetime.now(timezone.utc).isoformat()
+        with self.session():
+            expired_eids = [
+                a_summary.eid for a_summary
+                in self.store.search_by_results(["Start"])
+                if a_summary.get("lease_expires_at", now_str) < now_str]
+            if expired_eids:
+                self.update_result_summary_in_db(
+                    {"result": "Waiting"}, eids=expired_eids)
+        return expired_eids
 
     def save_result_summaries(self, result_summaries):
-        with TinyDB(self.file_name) as db_entity:
-            eids = db_entity.insert_multiple(result_summaries)
-            return eids
-        return None
+        with self.session():
+            eids = self.store.insert(result_summaries)
+            counters = self.get_result_counters()
+            for a_summary in result_summaries:
+                self.__count_in(counters, a_summary)
+            self.__set_result_counters(counters)
+        return eids
 
     def update_result_summary_in_db(self, result_summary, eids):
-        with TinyDB(self.file_name) as db_entity:
-            eids2 = db_entity.update(result_summary, eids=eids)
-            return eids2
-        return True
+        with self.session():
+            old_summaries = [a_summary for a_summary
+                             in map(self.store.get, eids) if a_summary is not None]
+            updated_eids = self.store.update(result_summary, eids=eids)
+            counters = self.get_result_counters()
+            for a_summary in old_summaries:
+                self.__count_out(counters, a_summary)
+                self.__count_in(counters, dict(a_summary, **result_summary))
+            self.__set_result_counters(counters)
+        return updated_eids
 
     def dump_log(self):
-        with TinyDB(self.file_name) as db_entity:
-            return db_entity.all()
+        return self.store.all()
+
+    def iter_log(self, results=None, since="", until="", hashtag=""):
+        """Yields records one by one in eid order.
+
+        Records are filtered by results, processed_at in [since, until) and
+        hashtag. Empty filters are skipped. since and until are date or time
+        strings, which are taken as UTC without a timezone.
+        """
+        return self.store.iter_records(
+            results=list(results) if results else None,
+            since=self.__to_utc_isoformat(since),
+            until=self.__to_utc_isoformat(until),
+            hashtag=hashtag.lstrip("#") or None)
+
+    @staticmethod
+    def __to_utc_isoformat(time_str):
+        if not time_str:
+            return None
+        time = parse(time_str)
+        if time.tzinfo is None:
+            time = time.replace(tzinfo=timezone.utc)
+        return time.astimezone(timezone.utc).isoformat()
 
     def remove_summaries_by_eids(self, eids):
-        with TinyDB(self.file_name) as db_entity:
-            return db_entity.remove(eids=eids)
+        with self.session():
+            old_summaries = {a_summary.eid: a_summary for a_summary
+                             in map(self.store.get, eids) if a_summary is not None}
+            removed_eids = self.store.remove(eids)
+            counters = self.get_result_counters()
+            for a_eid in removed_eids:
+                self.__count_out(counters, old_summaries[a_eid])
+            self.__set_result_counters(counters)
+        return removed_eids
+
+    def get_result_counters(self):
+        """Returns {result: {'count', 'first_processed_at',
+        'last_processed_at'}} of records in the log DB."""
+        item = self.store.get_info_item('name', 'result_counters')
+        return item['results'] if item else {}
+
+    def verify_result_counters(self):
+        """Rebuilds the result counters from all records.
+        Returns {result: (saved_count, actual_count)} of results whose saved
+        counter was wrong."""
+        with self.session():
+            saved_counters = self.get_result_counters()
+            counters = {}
+            for a_summary in self.store.all():
+                self.__count_in(counters, a_summary)
+            self.__set_result_counters(counters)
+        drifts = {}
+        for a_result in set(saved_counters) | set(counters):
+            [saved_counter, counter] = [
+                a_counters.get(a_result, {"count": 0})
+                for a_counters in [saved_counters, counters]]
+            if saved_counter != counter:
+                drifts[a_result] = (saved_counter["count"], counter["count"])
+        return drifts
+
+    def __set_result_counters(self, counters):
+        self.store.set_info_item(
+            'name', 'result_counters', {'results': counters})
+
+    @staticmethod
+    def __count_in(counters, summary):
+        counter = counters.setdefault(summary.get("result"), {"count": 0})
+        counter["count"] += 1
+        processed_at = summary.get("processed_at")
+        if processed_at is None:
+            return
+        if counter.get("first_processed_at", processed_at) >= processed_at:
+            counter["first_processed_at"] = processed_at
+        if counter.get("last_processed_at", processed_at) <= processed_at:
+            counter["last_processed_at"] = processed_at
+
+    def __count_out(self, counters, summary):
+        result = summary.get("result")
+        counter = counters.get(result)
+        if counter is None:
+            return
+        counter["count"] -= 1
+        if counter["count"] <= 0:
+            del counters[result]
+        elif summary.get("processed_at") in [counter.get("first_processed_at"),
+                                             counter.get("last_processed_at")]:
+            # The record held a bound, so it's searched again among the rest.
+            bounds = {}
+            for a_summary in self.store.search_by_results([result]):
+                self.__count_in(bounds, a_summary)
+            counter.update({a_key: a_value for a_key, a_value
+                            in bounds.get(result, {}).items() if a_key != "count"})
+
+    def get_compaction_options(self):
+        """Returns keyword arguments of compact_log() from the [result log]
+        section."""
+        log_conf = self.items["result log"]
+        return {
+            "retain_days": log_conf.getint("retain_days", fallback=30),
+            "archive_dir": log_conf.get("archive_dir", "") or os.path.dirname(
+                os.path.abspath(self.file_name)),
+            "compression": log_conf.get("archive_compression", "gzip")}
+
+    def compact_log(self, retain_days, archive_dir, compression="gzip"):
+        """Moves Succeed and Test records processed more than retain_days
+        ago to monthly compressed JSON lines archives in archive_dir.
+
+        The inbound status IDs of archived records are kept in the log DB,
+        so that these statuses are not transported again.
+        Returns the number of archived records.
+        """
+        now = datetime.now(timezone.utc)
+        cutoff = (now - timedelta(days=retain_days)).isoformat()
+        with self.session():
+            summaries = [
+                a_summary for a_summary
+                in self.store.search_by_results(["Succeed", "Test"])
+                if a_summary.get("processed_at", "") < cutoff]
+            if summaries:
+                self.__write_archives(summaries, archive_dir, compression)
+                archived_statuses = {}
+                for a_summary in summaries:
+                    if "inbound_status_id" not in a_summary:
+                        continue
+                    archived_statuses.setdefault(
+                        a_summary["inbound"], {})[
+                            str(a_summary["inbound_status_id"])] = \
+                        a_summary["result"]
+                self.store.add_archived_statuses(archived_statuses)
+                self.remove_summaries_by_eids(
+                    [a_summary.eid for a_summary in summaries])
+            self.store.set_info_item(
+                'name', 'compaction', {'compacted_at': now.isoformat()})
+        return len(summaries)
+
+    def compact_log_if_due(self):
+        """Runs compact_log() once a day when retain_days is set in the
+        [result log] section."""
+        if not self.items["result log"].get("retain_days", ""):
+            return 0
+        compaction = self.store.get_info_item('name', 'compaction')
+        last_day = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
+        if compaction and compaction["compacted_at"] > last_day:
+            return 0
+        return self.compact_log(**self.get_compaction_options())
+
+    def __write_archives(self, summaries, archive_dir, compression):
+        if compression == "gzip":
+            compress = gzip.compress
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise DontwiConfigError(
+                    'zstandard package is required for zstd archives')
+            compress = zstandard.ZstdCompressor().compress
+        else:
+            raise DontwiConfigError(
+                'Unknown archive compression \'{0}\''.format(compression))
+        summaries_by_month = {}
+        for a_summary in summaries:
+            month = a_summary.get("processed_at", "")[:7] or "unknown"
+            summaries_by_month.setdefault(month, []).append(a_summary)
+        os.makedirs(archive_dir, exist_ok=True)
+        for month, month_summaries in sorted(summaries_by_month.items()):
+            archive_name = os.path.join(archive_dir, "{0}-{1}.jsonl.{2}".format(
+                os.path.basename(self.file_name), month,
+                "gz" if compression == "gzip" else "zst"))
+            lines = "".join(
+                json.dumps(dict(a_summary, eid=a_summary.eid)) + "\n"
+                for a_summary in month_summaries)
+            # Compressed data is appended as a new gzip member or zstd frame,
+            # and both formats read concatenated ones as one stream.
+            with open(archive_name, "ab") as archive_file:
+                archive_file.write(compress(lines.encode("utf-8")))
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
 
     def make_status_summary(self, direction, status):
         summary = {
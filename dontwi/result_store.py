@@ -0,0 +1,1076 @@
+# -*- coding: utf-8 -*-
+"""Storage backends of the result log
+"""
+import copy
+import fcntl
+import heapq
+import json
+import os
+import sqlite3
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from functools import reduce
+from operator import itemgetter, or_
+from tempfile import mkstemp
+
+from tinydb import Query, TinyDB
+from tinydb.database import Table
+from tinydb.middlewares import Middleware
+from tinydb.storages import Storage
+
+from .exception import DontwiNotImplementedError, DontwiResultLogError
+
+
+class Record(dict):
+    """Log record with its ID, which behaves like tinydb's Element"""
+
+    def __init__(self, value, eid):
+        super().__init__(value)
+        self.eid = eid
+        self.doc_id = eid
+
+
+hot_results = ("Waiting", "Start")
+
+
+def tinydb_records(data):
+    """Returns {eid: record} of the data of a TinyDB log DB file."""
+    return {int(a_eid): a_document
+            for a_name in ['_default', 'queue', 'history']
+            for a_eid, a_document in data.get(a_name, {}).items()}
+
+
+@contextmanager
+def file_lock(file_name):
+    """Holds an exclusive lock on '<file_name>.lock' against other processes
+    and other stores in the same process."""
+    with open(file_name + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def is_matched(document, results=None, since=None, until=None, hashtag=None):
+    """Tests a record with filters of IResultStore.iter_records()."""
+    processed_at = document.get("processed_at")
+    return (results is None or document.get("result") in results)\
+        and (since is None or processed_at is not None and processed_at >= since)\
+        and (until is None or processed_at is not None and processed_at < until)\
+        and (hashtag is None or document.get("hashtag") == hashtag)
+
+
+def queue_order(document):
+    """Returns the position of a Waiting record in the queue.
+
+    It is the inbound status ID, which increases with the time of posting
+    in Mastodon.
+    """
+    status_id = str(document.get('inbound_status_id', ''))
+    return int(status_id) if status_id.isdigit() else 0
+
+
+class ResultIndex(object):
+    """Secondary indexes of records for stores which load all of them
+
+    statuses maps inbound and inbound_status_id to {eid: result}, and
+    waiting is the ascending list of [queue_order, eid] of Waiting records.
+    """
+
+    names = ['inbound_status', 'waiting_queue']
+
+    def __init__(self, entries=None):
+        entries = entries if entries is not None else {}
+        self.statuses = entries.get('inbound_status', {})
+        self.waiting = entries.get('waiting_queue', [])
+
+    @classmethod
+    def build(cls, eids_and_documents):
+        index = cls()
+        for a_eid, a_document in eids_and_documents:
+            index.add(a_eid, a_document)
+        return index
+
+    def to_entries(self):
+        return {'inbound_status': self.statuses, 'waiting_queue': self.waiting}
+
+    def add(self, eid, document):
+        if 'inbound' in document and 'inbound_status_id' in document:
+            status_results = self.statuses.setdefault(
+                document['inbound'], {}).setdefault(
+                    str(document['inbound_status_id']), {})
+            status_results[str(eid)] = document.get('result')
+        if document.get('result') == 'Waiting':
+            insort(self.waiting, [queue_order(document), eid])
+
+    def discard(self, eid, document):
+        if 'inbound' in document and 'inbound_status_id' in document:
+            inbound_entries = self.statuses.get(document['inbound'], {})
+            status_id = str(document['inbound_status_id'])
+            status_results = inbound_entries.get(status_id, {})
+            status_results.pop(str(eid), None)
+            if not status_results:
+                inbound_entries.pop(status_id, None)
+        if document.get('result') == 'Waiting':
+            entry = [queue_order(document), eid]
+            position = bisect_left(self.waiting, entry)
+            if position < len(self.waiting) and self.waiting[position] == entry:
+                del self.waiting[position]
+
+    def results_by_status(self, inbound, status_ids):
+        inbound_entries = self.statuses.get(inbound, {})
+        return {a_status_id: {int(a_eid): a_result for a_eid, a_result
+                              in inbound_entries[a_status_id].items()}
+                for a_status_id in status_ids
+                if a_status_id in inbound_entries}
+
+    def first_waiting(self):
+        return self.waiting[0][1] if self.waiting else None
+
+
+class IResultStore(metaclass=ABCMeta):
+    """Interface for storage of result log records"""
+
+    @abstractmethod
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    @abstractmethod
+    def session(self):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def commit(self):
+        raise DontwiNotImplementedError
+
+    def close(self):
+        pass
+
+    def check_index(self):
+        pass
+
+    def rebuild_index(self):
+        pass
+
+    def split_tables(self):
+        pass
+
+    def archived_results(self, inbound, status_ids):
+        """Returns {status_id: result} of the specified statuses whose
+        records were moved to archives."""
+        item = self.get_info_item('name', 'archived_statuses') or {}
+        inbound_statuses = item.get('statuses', {}).get(inbound, {})
+        return {a_status_id: inbound_statuses[a_status_id]
+                for a_status_id in status_ids
+                if a_status_id in inbound_statuses}
+
+    def add_archived_statuses(self, statuses):
+        """Adds {inbound: {status_id: result}} of archived records."""
+        with self.session():
+            item = self.get_info_item('name', 'archived_statuses') or {}
+            archived_statuses = item.get('statuses', {})
+            for a_inbound, a_statuses in statuses.items():
+                archived_statuses.setdefault(a_inbound, {}).update(a_statuses)
+            self.set_info_item('name', 'archived_statuses',
+                               {'statuses': archived_statuses})
+
+    @abstractmethod
+    def get_info_item(self, key, value):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def set_info_item(self, key, value, fields):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def count(self):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def get(self, eid):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def all(self):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def search_by_results(self, results):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def iter_records(self, results=None, since=None, until=None, hashtag=None):
+        """Yields records in eid order which have one of the results and
+        processed_at in [since, until), and which were made for hashtag.
+        since and until are ISO format strings in UTC. None skips a filter."""
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def results_by_status(self, inbound, status_ids):
+        """Returns {status_id: {eid: result}} of the specified statuses."""
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def first_waiting(self):
+        """Returns the Waiting record of the oldest inbound status."""
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def insert(self, documents):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def update(self, fields, eids):
+        raise DontwiNotImplementedError
+
+    @abstractmethod
+    def remove(self, eids):
+        raise DontwiNotImplementedError
+
+
+class AtomicJSONStorage(Storage):
+    """JSON file storage which replaces the whole file atomically on write"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return None
+        with open(self.path, encoding="utf-8") as db_file:
+            return json.load(db_file)
+
+    def write(self, data):
+        dir_name = os.path.dirname(os.path.abspath(self.path))
+        temp_fd, temp_name = mkstemp(dir=dir_name, suffix=".tmp")
+        try:
+            with os.fdopen(temp_fd, "w", encoding="utf-8") as temp_file:
+                json.dump(data, temp_file)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_name, self.path)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+
+
+class SessionMiddleware(Middleware):
+    """Keeps the DB state in memory until commit() is called"""
+
+    def __init__(self, storage_cls=AtomicJSONStorage):
+        super().__init__(storage_cls)
+        self.cache = None
+        self.is_modified = False
+
+    def read(self):
+        if self.cache is None:
+            self.cache = self.storage.read()
+        return self.cache
+
+    def write(self, data):
+        self.cache = data
+        self.is_modified = True
+
+    def commit(self):
+        if self.is_modified:
+            self.storage.write(self.cache)
+            self.is_modified = False
+
+    def close(self):
+        self.storage.close()
+
+
+class LogTable(Table):
+    """TinyDB table whose records keep eids given by the store, so that the
+    eid of a record doesn't change when it moves between tables"""
+
+    @property
+    def last_eid(self):
+        return self._last_id
+
+    def insert_with_eid(self, document, eid):
+        data = self._read()
+        data[eid] = dict(document)
+        self._write(data)
+        self._last_id = max(self._last_id, eid)
+        return eid
+
+
+class TinyDBResultStore(IResultStore):
+    """Result log on a TinyDB JSON file
+
+    Records still in process (Waiting, Start) are kept in the small 'queue'
+    table and finished records are moved to the 'history' table, so that
+    dequeuing and processing don't read the whole history.
+    """
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self._session_db = None
+        self._session_storage = None
+
+    @contextmanager
+    def session(self):
+        """Loads the DB file once and writes all changes made in the block
+        at the end of it as one atomic file replacement.
+
+        Changes are discarded when the block raises an exception.
+        Nested sessions share the outer one. Sessions of other processes
+        wait for the end of the block.
+        """
+        if self._session_db is not None:
+            yield self
+            return
+        with file_lock(self.file_name):
+            self._session_storage = SessionMiddleware(AtomicJSONStorage)
+            self._session_db = TinyDB(self.file_name,
+                                      storage=self._session_storage)
+            try:
+                yield self
+                self.commit()
+            finally:
+                self._session_db.close()
+                self._session_db = None
+                self._session_storage = None
+
+    def commit(self):
+        if self._session_storage is not None:
+            self._session_storage.commit()
+
+    @contextmanager
+    def __open_db(self):
+        if self._session_db is not None:
+            yield self._session_db
+        else:
+            with self.session():
+                yield self._session_db
+
+    def get_info_item(self, key, value):
+        with self.__open_db() as db_entity:
+            items = db_entity.table('info').search(Query()[key] == value)
+        return items[0] if items else None
+
+    def set_info_item(self, key, value, fields):
+        with self.__open_db() as db_entity:
+            info_table = db_entity.table('info')
+            items = info_table.search(Query()[key] == value)
+            if not items:
+                item = {key: value}
+                item.update(fields)
+                info_table.insert(item)
+            else:
+                info_table.update(fields, eids=[items[0].eid])
+
+    def __load_index(self, db_entity):
+        entries = {a_item['name']: a_item['entries']
+                   for a_item in db_entity.table('index').all()}
+        if any(a_name not in entries for a_name in ResultIndex.names):
+            return self.rebuild_index()
+        return ResultIndex(entries)
+
+    @staticmethod
+    def __save_index(db_entity, index):
+        index_table = db_entity.table('index')
+        item_eids = {a_item['name']: a_item.eid for a_item in index_table.all()}
+        for a_name, a_entries in index.to_entries().items():
+            if a_name in item_eids:
+                index_table.update({'entries': a_entries},
+                                   eids=[item_eids[a_name]])
+            else:
+                index_table.insert({'name': a_name, 'entries': a_entries})
+
+    def check_index(self):
+        with self.__open_db() as db_entity:
+            self.__load_index(db_entity)
+
+    def rebuild_index(self):
+        """Builds the indexes in the 'index' table from all records."""
+        with self.__open_db() as db_entity:
+            index = ResultIndex.build(
+                (element.eid, element) for a_table in self.__get_tables(db_entity)
+                for element in a_table)
+            self.__save_index(db_entity, index)
+        return index
+
+    def __get_tables(self, db_entity):
+        return [db_entity.table(a_name, table_class=LogTable)
+                for a_name in ['queue', 'history']]
+
+    def __get_table_of_result(self, db_entity, result):
+        [queue_table, history_table] = self.__get_tables(db_entity)
+        return queue_table if result in hot_results else history_table
+
+    def __find(self, db_entity, eid):
+        for a_table in self.__get_tables(db_entity):
+            element = a_table.get(eid=eid)
+            if element is not None:
+                return a_table, element
+        return None, None
+
+    def __get_next_eid(self, db_entity):
+        return max(a_table.last_eid
+                   for a_table in self.__get_tables(db_entity)) + 1
+
+    def split_tables(self):
+        """Moves records in the default table of older versions to the queue
+        and history tables keeping their eids."""
+        with self.__open_db() as db_entity:
+            for element in db_entity.all():
+                self.__get_table_of_result(
+                    db_entity, element.get('result')).insert_with_eid(
+                        element, element.eid)
+            db_entity.purge()
+            self.rebuild_index()
+
+    def count(self):
+        with self.__open_db() as db_entity:
+            return sum(len(a_table) for a_table in self.__get_tables(db_entity))
+
+    def get(self, eid):
+        with self.__open_db() as db_entity:
+            return self.__find(db_entity, eid)[1]
+
+    def all(self):
+        with self.__open_db() as db_entity:
+            elements = [element for a_table in self.__get_tables(db_entity)
+                        for element in a_table.all()]
+        return sorted(elements, key=lambda element: element.eid)
+
+    def search_by_results(self, results):
+        query = Query()
+        querys = [query.result == a_result for a_result in results]
+        combined_query = reduce(or_, querys)
+        with self.__open_db() as db_entity:
+            [queue_table, history_table] = self.__get_tables(db_entity)
+            elements = []
+            if any(a_result in hot_results for a_result in results):
+                elements += queue_table.search(combined_query)
+            if any(a_result not in hot_results for a_result in results):
+                elements += history_table.search(combined_query)
+        return sorted(elements, key=lambda element: element.eid)
+
+    def iter_records(self, results=None, since=None, until=None, hashtag=None):
+        # TinyDB loads the whole file anyway, but records are yielded one by
+        # one without building a list of them.
+        with self.__open_db() as db_entity:
+            [queue_table, history_table] = self.__get_tables(db_entity)
+            tables = []
+            if results is None or any(a_result in hot_results
+                                      for a_result in results):
+                tables.append(queue_table)
+            if results is None or any(a_result not in hot_results
+                                      for a_result in results):
+                tables.append(history_table)
+            for a_eid, element in heapq.merge(
+                    *[sorted(a_table._read().items()) for a_table in tables],
+                    key=itemgetter(0)):
+                if is_matched(element, results, since, until, hashtag):
+                    yield element
+
+    def results_by_status(self, inbound, status_ids):
+        with self.__open_db() as db_entity:
+            return self.__load_index(db_entity).results_by_status(
+                inbound, status_ids)
+
+    def first_waiting(self):
+        with self.__open_db() as db_entity:
+            eid = self.__load_index(db_entity).first_waiting()
+            if eid is None:
+                return None
+            [queue_table, history_table] = self.__get_tables(db_entity)
+            return queue_table.get(eid=eid)
+
+    def insert(self, documents):
+        with self.__open_db() as db_entity:
+            index = self.__load_index(db_entity)
+            eids = []
+            for a_document in documents:
+                eid = self.__get_next_eid(db_entity)
+                self.__get_table_of_result(
+                    db_entity, a_document.get('result')).insert_with_eid(
+                        a_document, eid)
+                index.add(eid, a_document)
+                eids.append(eid)
+            self.__save_index(db_entity, index)
+            return eids
+
+    def update(self, fields, eids):
+        with self.__open_db() as db_entity:
+            index = self.__load_index(db_entity)
+            updated_eids = []
+            for a_eid in eids:
+                table, element = self.__find(db_entity, a_eid)
+                if element is None:
+                    continue
+                index.discard(a_eid, element)
+                new_element = dict(element)
+                new_element.update(fields)
+                new_table = self.__get_table_of_result(
+                    db_entity, new_element.get('result'))
+                if new_table is table:
+                    table.update(fields, eids=[a_eid])
+                else:
+                    new_table.insert_with_eid(new_element, a_eid)
+                    table.remove(eids=[a_eid])
+                index.add(a_eid, new_element)
+                updated_eids.append(a_eid)
+            self.__save_index(db_entity, index)
+            return updated_eids
+
+    def remove(self, eids):
+        with self.__open_db() as db_entity:
+            index = self.__load_index(db_entity)
+            removed_eids = []
+            for a_eid in eids:
+                table, element = self.__find(db_entity, a_eid)
+                if element is None:
+                    continue
+                index.discard(a_eid, element)
+                removed_eids += table.remove(eids=[a_eid])
+            self.__save_index(db_entity, index)
+            return removed_eids
+
+
+class SqliteResultStore(IResultStore):
+    """Result log on a SQLite DB file
+
+    The searched fields of a record have their own indexed columns and
+    the whole record is kept as JSON in the document column.
+    An existing TinyDB file at the same path is migrated on the first open
+    and kept with the '.tinydb' suffix.
+    """
+
+    sqlite_header = b"SQLite format 3\x00"
+    record_columns = ["result", "inbound", "inbound_status_id", "processed_at"]
+    schema = [
+        "CREATE TABLE IF NOT EXISTS records ("
+        " eid INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " result TEXT, inbound TEXT, inbound_status_id TEXT,"
+        " processed_at TEXT, document TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS records_result ON records (result)",
+        "CREATE INDEX IF NOT EXISTS records_inbound_status"
+        " ON records (inbound, inbound_status_id)",
+        "CREATE INDEX IF NOT EXISTS records_processed_at"
+        " ON records (processed_at)",
+        "CREATE INDEX IF NOT EXISTS records_waiting_queue"
+        " ON records (CAST(inbound_status_id AS INTEGER), eid)"
+        " WHERE result = 'Waiting'",
+        "CREATE TABLE IF NOT EXISTS info ("
+        " name TEXT PRIMARY KEY, document TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS archived_statuses ("
+        " inbound TEXT, inbound_status_id TEXT, result TEXT,"
+        " PRIMARY KEY (inbound, inbound_status_id))"]
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        if os.path.exists(file_name) and os.path.getsize(file_name)\
+                and not self.is_sqlite_file(file_name):
+            self.migrate_from_tinydb()
+        self.connection = self.__connect(file_name)
+        self._in_session = False
+
+    @classmethod
+    def is_sqlite_file(cls, file_name):
+        with open(file_name, "rb") as db_file:
+            return db_file.read(len(cls.sqlite_header)) == cls.sqlite_header
+
+    @classmethod
+    def __connect(cls, file_name):
+        connection = sqlite3.connect(file_name, isolation_level=None,
+                                     timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        for a_statement in cls.schema:
+            connection.execute(a_statement)
+        return connection
+
+    def migrate_from_tinydb(self):
+        """Copies records and info of the TinyDB file to a new SQLite file
+        keeping their eids, and replaces the TinyDB file with it."""
+        data = AtomicJSONStorage(self.file_name).read() or {}
+        temp_name = self.file_name + ".sqlite.tmp"
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        connection = self.__connect(temp_name)
+        try:
+            connection.execute("BEGIN")
+            for a_eid, a_document in sorted(tinydb_records(data).items()):
+                connection.execute(
+                    "INSERT INTO records (eid, result, inbound,"
+                    " inbound_status_id, processed_at, document)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [a_eid] + self.__column_values(a_document)
+                    + [json.dumps(a_document)])
+            for a_item in data.get("info", {}).values():
+                if not a_item:
+                    continue
+                [(key, value)] = list(a_item.items())[:1]
+                connection.execute(
+                    "INSERT OR REPLACE INTO info (name, document) VALUES (?, ?)",
+                    [self.__info_name(key, value), json.dumps(a_item)])
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        os.replace(self.file_name, self.file_name + ".tinydb")
+        os.replace(temp_name, self.file_name)
+
+    @contextmanager
+    def session(self):
+        """Runs the block in one transaction.
+
+        Readers in other processes see the DB as of the last commit.
+        Nested sessions share the outer one. The transaction takes the write
+        lock at its beginning, so sessions of other processes wait for its
+        end instead of failing on their first write.
+        """
+        if self._in_session:
+            yield self
+            return
+        self._in_session = True
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        finally:
+            self._in_session = False
+
+    def commit(self):
+        if self._in_session:
+            self.connection.execute("COMMIT")
+            self.connection.execute("BEGIN IMMEDIATE")
+
+    def close(self):
+        self.connection.close()
+
+    def rebuild_index(self):
+        self.connection.execute("REINDEX records")
+
+    @staticmethod
+    def __info_name(key, value):
+        return "{0}:{1}".format(key, value)
+
+    def get_info_item(self, key, value):
+        row = self.connection.execute(
+            "SELECT document FROM info WHERE name = ?",
+            [self.__info_name(key, value)]).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_info_item(self, key, value, fields):
+        with self.session():
+            item = self.get_info_item(key, value) or {key: value}
+            item.update(fields)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO info (name, document) VALUES (?, ?)",
+                [self.__info_name(key, value), json.dumps(item)])
+
+    @classmethod
+    def __column_values(cls, document):
+        values = [document.get(a_column) for a_column in cls.record_columns]
+        if values[2] is not None:
+            values[2] = str(values[2])
+        return values
+
+    @staticmethod
+    def __to_records(rows):
+        return [Record(json.loads(a_document), a_eid)
+                for a_eid, a_document in rows]
+
+    def count(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def get(self, eid):
+        records = self.__to_records(self.connection.execute(
+            "SELECT eid, document FROM records WHERE eid = ?", [eid]))
+        return records[0] if records else None
+
+    def all(self):
+        return self.__to_records(self.connection.execute(
+            "SELECT eid, document FROM records ORDER BY eid"))
+
+    def search_by_results(self, results):
+        results = list(results)
+        return self.__to_records(self.connection.execute(
+            "SELECT eid, document FROM records WHERE result IN ({0})"
+            " ORDER BY eid".format(", ".join("?" * len(results))), results))
+
+    def iter_records(self, results=None, since=None, until=None, hashtag=None):
+        conditions, parameters = [], []
+        if results is not None:
+            results = list(results)
+            conditions.append(
+                "result IN ({0})".format(", ".join("?" * len(results))))
+            parameters += results
+        if since is not None:
+            conditions.append("processed_at >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("processed_at < ?")
+            parameters.append(until)
+        rows = self.connection.execute(
+            "SELECT eid, document FROM records{0} ORDER BY eid".format(
+                " WHERE " + " AND ".join(conditions) if conditions else ""),
+            parameters)
+        for a_eid, a_document in rows:
+            record = Record(json.loads(a_document), a_eid)
+            if hashtag is None or record.get("hashtag") == hashtag:
+                yield record
+
+    def results_by_status(self, inbound, status_ids):
+        status_ids = list(status_ids)
+        results = {}
+        for start in range(0, len(status_ids), 500):
+            chunk = status_ids[start:start + 500]
+            rows = self.connection.execute(
+                "SELECT eid, inbound_status_id, result FROM records"
+                " WHERE inbound = ? AND inbound_status_id IN ({0})".format(
+                    ", ".join("?" * len(chunk))), [inbound] + chunk)
+            for a_eid, a_status_id, a_result in rows:
+                results.setdefault(a_status_id, {})[a_eid] = a_result
+        return results
+
+    def archived_results(self, inbound, status_ids):
+        status_ids = list(status_ids)
+        results = {}
+        for start in range(0, len(status_ids), 500):
+            chunk = status_ids[start:start + 500]
+            rows = self.connection.execute(
+                "SELECT inbound_status_id, result FROM archived_statuses"
+                " WHERE inbound = ? AND inbound_status_id IN ({0})".format(
+                    ", ".join("?" * len(chunk))), [inbound] + chunk)
+            results.update(rows)
+        return results
+
+    def add_archived_statuses(self, statuses):
+        with self.session():
+            for a_inbound, a_statuses in statuses.items():
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO archived_statuses"
+                    " (inbound, inbound_status_id, result) VALUES (?, ?, ?)",
+                    [(a_inbound, a_status_id, a_result)
+                     for a_status_id, a_result in a_statuses.items()])
+
+    def first_waiting(self):
+        records = self.__to_records(self.connection.execute(
+            "SELECT eid, document FROM records"
+            " INDEXED BY records_waiting_queue WHERE result = 'Waiting'"
+            " ORDER BY CAST(inbound_status_id AS INTEGER), eid LIMIT 1"))
+        return records[0] if records else None
+
+    def insert(self, documents):
+        eids = []
+        with self.session():
+            for a_document in documents:
+                cursor = self.connection.execute(
+                    "INSERT INTO records (result, inbound, inbound_status_id,"
+                    " processed_at, document) VALUES (?, ?, ?, ?, ?)",
+                    self.__column_values(a_document) + [json.dumps(a_document)])
+                eids.append(cursor.lastrowid)
+        return eids
+
+    def update(self, fields, eids):
+        updated_eids = []
+        with self.session():
+            for a_eid in eids:
+                record = self.get(a_eid)
+                if record is None:
+                    continue
+                record.update(fields)
+                self.connection.execute(
+                    "UPDATE records SET result = ?, inbound = ?,"
+                    " inbound_status_id = ?, processed_at = ?, document = ?"
+                    " WHERE eid = ?",
+                    self.__column_values(record) + [json.dumps(record), a_eid])
+                updated_eids.append(a_eid)
+        return updated_eids
+
+    def remove(self, eids):
+        removed_eids = []
+        with self.session():
+            for a_eid in eids:
+                cursor = self.connection.execute(
+                    "DELETE FROM records WHERE eid = ?", [a_eid])
+                if cursor.rowcount:
+                    removed_eids.append(a_eid)
+        return removed_eids
+
+
+class JournalResultStore(IResultStore):
+    """Result log on an append-only JSON lines journal
+
+    Each change is appended to the journal file as one line and the current
+    state is rebuilt by replaying it on open. A snapshot of the whole state
+    is written to '<db_file>.snapshot' every snapshot_interval changes and
+    the journal is truncated after it. A torn last line, which is left by
+    a crash while appending, is dropped on open.
+    An existing TinyDB file at the same path is migrated on the first open
+    and kept with the '.tinydb' suffix.
+    """
+
+    def __init__(self, file_name, snapshot_interval=1000):
+        super().__init__(file_name)
+        self.snapshot_name = file_name + ".snapshot"
+        self.snapshot_interval = snapshot_interval
+        self._in_session = False
+        self._pending = []
+        if self.is_tinydb_file(file_name):
+            self.migrate_from_tinydb()
+        self.__load()
+
+    @staticmethod
+    def is_tinydb_file(file_name):
+        if not os.path.exists(file_name) or not os.path.getsize(file_name):
+            return False
+        with open(file_name, "rb") as db_file:
+            first_line = db_file.readline()
+        try:
+            first_entry = json.loads(first_line.decode("utf-8"))
+        except ValueError:
+            return False
+        return isinstance(first_entry, dict) and "op" not in first_entry
+
+    def migrate_from_tinydb(self):
+        """Writes the records and info of the TinyDB file as a snapshot
+        keeping their eids, and starts an empty journal."""
+        data = AtomicJSONStorage(self.file_name).read() or {}
+        records = tinydb_records(data)
+        info = {}
+        for a_item in data.get("info", {}).values():
+            if a_item:
+                [(key, value)] = list(a_item.items())[:1]
+                info[self.__info_name(key, value)] = a_item
+        AtomicJSONStorage(self.snapshot_name).write({
+            "seq": 0,
+            "last_eid": max(records, default=0),
+            "records": {str(a_eid): a_document
+                        for a_eid, a_document in records.items()},
+            "info": info})
+        os.replace(self.file_name, self.file_name + ".tinydb")
+        open(self.file_name, "wb").close()
+
+    def __load(self):
+        snapshot = AtomicJSONStorage(self.snapshot_name).read() or {}
+        self.seq = snapshot.get("seq", 0)
+        self.last_eid = snapshot.get("last_eid", 0)
+        self.records = {int(a_eid): a_document for a_eid, a_document
+                        in snapshot.get("records", {}).items()}
+        self.info = snapshot.get("info", {})
+        self.index = ResultIndex.build(self.records.items())
+        self.journal_offset = 0
+        self.journal_length = 0
+        self.snapshot_stat = self.__get_snapshot_stat()
+        self.__replay()
+
+    def __get_snapshot_stat(self):
+        if not os.path.exists(self.snapshot_name):
+            return None
+        snapshot_stat = os.stat(self.snapshot_name)
+        return snapshot_stat.st_mtime_ns, snapshot_stat.st_size
+
+    def __replay(self):
+        """Applies journal entries appended after the last read."""
+        if not os.path.exists(self.file_name):
+            open(self.file_name, "ab").close()
+        with open(self.file_name, "rb") as journal_file:
+            journal_file.seek(self.journal_offset)
+            lines = journal_file.readlines()
+        for index, a_line in enumerate(lines):
+            try:
+                if not a_line.endswith(b"\n"):
+                    raise ValueError
+                entry = json.loads(a_line.decode("utf-8"))
+            except ValueError:
+                if index != len(lines) - 1:
+                    raise DontwiResultLogError(
+                        'Broken entry in the journal \'{0}\''.format(
+                            self.file_name))
+                with open(self.file_name, "r+b") as journal_file:
+                    journal_file.truncate(self.journal_offset)
+                break
+            if entry["seq"] > self.seq:
+                self.__apply(entry)
+                self.seq = entry["seq"]
+            self.journal_offset += len(a_line)
+            self.journal_length += 1
+
+    def __refresh(self):
+        """Follows changes written by other processes."""
+        snapshot_stat = self.__get_snapshot_stat()
+        journal_size = os.path.getsize(self.file_name)\
+            if os.path.exists(self.file_name) else 0
+        if snapshot_stat != self.snapshot_stat\
+                or journal_size < self.journal_offset:
+            self.__load()
+        elif journal_size > self.journal_offset:
+            self.__replay()
+
+    def __follow(self):
+        if not self._in_session:
+            self.__refresh()
+
+    def __apply(self, entry):
+        op_str = entry["op"]
+        if op_str == "insert":
+            eid = entry["eid"]
+            self.records[eid] = entry["document"]
+            self.last_eid = max(self.last_eid, eid)
+            self.index.add(eid, entry["document"])
+        elif op_str == "update":
+            document = self.records[entry["eid"]]
+            self.index.discard(entry["eid"], document)
+            document.update(entry["fields"])
+            self.index.add(entry["eid"], document)
+        elif op_str == "remove":
+            document = self.records.pop(entry["eid"])
+            self.index.discard(entry["eid"], document)
+        elif op_str == "info":
+            self.info[entry["name"]] = entry["document"]
+        else:
+            raise DontwiResultLogError(
+                'Unknown operation \'{0}\' in the journal'.format(op_str))
+
+    def __append(self, entry):
+        entry["seq"] = self.seq + 1
+        self.__apply(copy.deepcopy(entry))
+        self.seq = entry["seq"]
+        self._pending.append(entry)
+
+    @contextmanager
+    def session(self):
+        """Appends all changes made in the block to the journal at the end
+        of it with one write and fsync.
+
+        Changes are discarded when the block raises an exception.
+        Nested sessions share the outer one. Sessions of other processes
+        wait for the end of the block.
+        """
+        if self._in_session:
+            yield self
+            return
+        with file_lock(self.file_name):
+            self._in_session = True
+            self.__refresh()
+            try:
+                yield self
+                self.commit()
+            except BaseException:
+                self._pending = []
+                self.__load()
+                raise
+            finally:
+                self._in_session = False
+
+    def commit(self):
+        if not self._pending:
+            return
+        lines = "".join(json.dumps(a_entry) + "\n"
+                        for a_entry in self._pending).encode("utf-8")
+        with open(self.file_name, "ab") as journal_file:
+            journal_file.write(lines)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self.journal_offset += len(lines)
+        self.journal_length += len(self._pending)
+        self._pending = []
+        if self.journal_length >= self.snapshot_interval:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """Writes the whole state to the snapshot and empties the journal."""
+        AtomicJSONStorage(self.snapshot_name).write({
+            "seq": self.seq,
+            "last_eid": self.last_eid,
+            "records": {str(a_eid): a_document
+                        for a_eid, a_document in self.records.items()},
+            "info": self.info})
+        with open(self.file_name, "r+b") as journal_file:
+            journal_file.truncate(0)
+        self.journal_offset = 0
+        self.journal_length = 0
+        self.snapshot_stat = self.__get_snapshot_stat()
+
+    @staticmethod
+    def __info_name(key, value):
+        return "{0}:{1}".format(key, value)
+
+    def get_info_item(self, key, value):
+        self.__follow()
+        item = self.info.get(self.__info_name(key, value))
+        return copy.deepcopy(item) if item is not None else None
+
+    def set_info_item(self, key, value, fields):
+        with self.session():
+            item = self.get_info_item(key, value) or {key: value}
+            item.update(fields)
+            self.__append({"op": "info", "name": self.__info_name(key, value),
+                           "document": item})
+
+    def __to_record(self, eid):
+        return Record(copy.deepcopy(self.records[eid]), eid)
+
+    def count(self):
+        self.__follow()
+        return len(self.records)
+
+    def get(self, eid):
+        self.__follow()
+        return self.__to_record(eid) if eid in self.records else None
+
+    def all(self):
+        self.__follow()
+        return [self.__to_record(a_eid) for a_eid in sorted(self.records)]
+
+    def search_by_results(self, results):
+        self.__follow()
+        return [self.__to_record(a_eid) for a_eid in sorted(self.records)
+                if self.records[a_eid].get("result") in results]
+
+    def iter_records(self, results=None, since=None, until=None, hashtag=None):
+        self.__follow()
+        for a_eid in sorted(self.records):
+            if is_matched(self.records[a_eid], results, since, until, hashtag):
+                yield self.__to_record(a_eid)
+
+    def results_by_status(self, inbound, status_ids):
+        self.__follow()
+        return self.index.results_by_status(inbound, status_ids)
+
+    def first_waiting(self):
+        self.__follow()
+        eid = self.index.first_waiting()
+        return self.__to_record(eid) if eid is not None else None
+
+    def insert(self, documents):
+        eids = []
+        with self.session():
+            for a_document in documents:
+                eid = self.last_eid + 1
+                self.__append({"op": "insert", "eid": eid,
+                               "document": dict(a_document)})
+                eids.append(eid)
+        return eids
+
+    def update(self, fields, eids):
+        updated_eids = []
+        with self.session():
+            for a_eid in eids:
+                if a_eid in self.records:
+                    self.__append({"op": "update", "eid": a_eid,
+                                   "fields": dict(fields)})
+                    updated_eids.append(a_eid)
+        return updated_eids
+
+    def remove(self, eids):
+        removed_eids = []
+        with self.session():
+            for a_eid in eids:
+                if a_eid in self.records:
+                    self.__append({"op": "remove", "eid": a_eid})
+                    removed_eids.append(a_eid)
+        return removed_eids
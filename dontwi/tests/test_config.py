@@ -3,6 +3,7 @@
 import codecs
 import configparser
 import os
+import shutil
 import unittest
 
 from ..config import Config
@@ -49,16 +50,18 @@ class TestConfig(unittest.TestCase):
         self.assertTrue(is_ng)
 
 
-def make_loaded_dummy_config(your_mastodon_fqdn=None, your_hashtag=None):
+def make_loaded_dummy_config(your_mastodon_fqdn=None, your_hashtag=None,
+                             backend=None):
     f_name = make_dummy_config_file(your_mastodon_fqdn=your_mastodon_fqdn,
-                                    your_hashtag=your_hashtag)
+                                    your_hashtag=your_hashtag, backend=backend)
     conf = Config()
     conf.filename = f_name
     conf.load()
     return conf
 
 
-def make_dummy_config_file(your_mastodon_fqdn=None, your_hashtag=None):
+def make_dummy_config_file(your_mastodon_fqdn=None, your_hashtag=None,
+                           backend=None):
     config_str = '''
 [operation]
 inbound = your_mastodon
@@ -92,6 +95,8 @@ handler = StreamHandler
         config_str.replace('your_hashtag', your_hashtag)
     cf_parser = configparser.ConfigParser()
     cf_parser.read_string(config_str)
+    if backend is not None:
+        cf_parser["result log"]["backend"] = backend
     f_name = "_dontwi.ini"
     with codecs.open(f_name, "w", "utf-8") as cf_file:
         cf_parser.write(cf_file)
@@ -99,10 +104,14 @@ handler = StreamHandler
 
 
 def remove_dummy_files():
-    f_names = ['_dontwi.ini', '_dontwi_log.db']
+    f_names = ['_dontwi.ini', '_dontwi_log.db', '_dontwi_log.db-wal',
+               '_dontwi_log.db-shm', '_dontwi_log.db.tinydb',
+               '_dontwi_log.db.snapshot']
     for f_name in f_names:
         if os.path.isfile(f_name):
             os.remove(f_name)
+    if os.path.isdir('_dontwi_archive'):
+        shutil.rmtree('_dontwi_archive')
 
 
 if __name__ == '__main__':
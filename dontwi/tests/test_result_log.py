@@ -1,5 +1,6 @@
 #!  /usr/bin/python3
 # -*- coding: utf-8 -*-
+import gzip
 import json
 import os.path
 import unittest
@@ -7,11 +8,13 @@ from datetime import datetime
 from copy import deepcopy
 
 from dateutil.parser import parse as timestamp_parse
-from tinydb import database
+from tinydb import TinyDB, database
 
 from ..connector import TootStatus, TweetStatus
 from ..result_log import ResultLog
+from ..result_store import JournalResultStore, SqliteResultStore
 from ..status_text import StatusText
+from ..version import __version__
 from .test_config import make_loaded_dummy_config, remove_dummy_files
 
 
@@ -122,8 +125,430 @@ class TestStatusLog(unittest.TestCase):
         self.assertFalse(waiting_summaries2)
 
     def test_has_result_of_status(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log()
+        self.assertTrue(result_log.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+        self.assertFalse(result_log.has_result_of_status(
+            status=tt_status, results=["Waiting", "Failed"]))
+        [succeed_summary] = result_log.get_result_summaries_by_status(
+            status=tt_status)
+        result_log.update_result_summary_in_db(
+            result_summary={"result": "Failed"}, eids=[succeed_summary.eid])
+        self.assertTrue(result_log.has_result_of_status(
+            status=tt_status, results=["Failed"]))
+        self.assertFalse(result_log.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+        result_log.remove_summaries_by_eids([succeed_summary.eid])
+        self.assertFalse(result_log.has_result_of_status(
+            status=tt_status, results=["Succeed", "Failed"]))
+        self.assertEqual(
+            result_log.get_result_summaries_by_status(status=tt_status), [])
+
+    def test_filter_unprocessed(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log()
+        statuses = []
+        for a_id in ["1345211", "1345221", "1345231"]:
+            a_status = deepcopy(tt_status)
+            a_status.status["id"] = a_id
+            statuses.append(a_status)
+        unprocessed = result_log.filter_unprocessed(statuses)
+        self.assertEqual([a_status.get_status_id() for a_status in unprocessed],
+                         ["1345221", "1345231"])
+        unprocessed2 = result_log.filter_unprocessed(
+            iter(statuses), results=["Succeed", "Waiting"])
+        self.assertEqual([a_status.get_status_id() for a_status in unprocessed2],
+                         ["1345231"])
+
+    def test_session(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log()
+        db_file = config.items["result log"]["db_file"]
+        record_number = result_log.get_record_number()
+        with result_log.session():
+            result_log.save_result_summaries(deepcopy(summaries))
+            [waiting_summary] = [
+                a_summary for a_summary in result_log.get_result_summaries_by_results(["Waiting"])
+                if a_summary.eid > record_number]
+            result_log.update_result_summary_in_db(
+                result_summary={"result": "Start"}, eids=[waiting_summary.eid])
+            self.assertEqual(result_log.get_record_number(), record_number + 2)
+            self.assertEqual(ResultLog(config.items).get_record_number(), record_number)
+        self.assertEqual(ResultLog(config.items).get_record_number(), record_number + 2)
+        self.assertEqual(
+            len(ResultLog(config.items).get_result_summaries_by_results(["Start"])), 1)
+        with self.assertRaises(RuntimeError):
+            with result_log.session():
+                result_log.remove_summaries_by_eids([waiting_summary.eid])
+                raise RuntimeError
+        self.assertEqual(result_log.get_record_number(), record_number + 2)
+        db_dir = os.path.dirname(os.path.abspath(db_file))
+        self.assertFalse([a_name for a_name in os.listdir(db_dir)
+                          if a_name.endswith(".tmp")])
+
+    def test_dequeue_waiting(self):
+        assert_dequeue_waiting_in_order(self, backend=None)
+
+    def test_queue_and_history_tables(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log()
+        db_file = config.items["result log"]["db_file"]
+        [waiting_summary] = result_log.get_result_summaries_by_results(["Waiting"])
+        with TinyDB(db_file) as db_entity:
+            self.assertEqual(len(db_entity.table("queue")), 1)
+            self.assertEqual(len(db_entity.table("history")), 1)
+        result_log.update_result_summary_in_db(
+            result_summary={"result": "Succeed"}, eids=[waiting_summary.eid])
+        with TinyDB(db_file) as db_entity:
+            self.assertEqual(len(db_entity.table("queue")), 0)
+            self.assertEqual(
+                [a_summary.doc_id for a_summary in db_entity.table("history").all()],
+                [1, waiting_summary.eid])
+        [new_eid] = result_log.save_result_summaries([{"result": "Waiting"}])
+        self.assertEqual(new_eid, 3)
+        self.assertEqual(result_log.get_record_number(), 3)
+        self.assertEqual(
+            [a_summary.eid for a_summary in result_log.get_result_summaries_by_results(
+                ["Waiting", "Succeed"])], [1, 2, 3])
+
+    def test_migrate_to_1_2(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log()
+        db_file = config.items["result log"]["db_file"]
+        remove_file(db_file)
+        with TinyDB(db_file) as db_entity:
+            db_entity.insert_multiple(summaries)
+            db_entity.table("info").insert(
+                {"application": "dontwi", "version": "1.1.1"})
+        result_log2 = ResultLog(config.items)
+        self.assertEqual(result_log2.get_info()["version"], __version__)
+        self.assertEqual(result_log2.get_record_number(), 2)
+        [waiting_summary] = result_log2.get_result_summaries_by_results(["Waiting"])
+        self.assertEqual(waiting_summary.eid, 2)
+        self.assertTrue(result_log2.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+        with TinyDB(db_file) as db_entity:
+            self.assertEqual(len(db_entity), 0)
+
+    def test_compact_log(self):
+        assert_compact_log(self, backend=None)
+
+    def test_result_counters(self):
+        assert_result_counters(self, backend=None)
+
+    def test_iter_log(self):
+        assert_iter_log(self, backend=None)
+
+    def test_rebuild_index(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log()
+        with TinyDB(config.items["result log"]["db_file"]) as db_entity:
+            db_entity.purge_table('index')
+        result_log2 = ResultLog(config.items)
+        self.assertTrue(result_log2.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+
+
+class TestSqliteStatusLog(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        remove_dummy_files()
+
+    def test_has_result_of_status(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log(backend="sqlite")
+        self.assertIsInstance(result_log.store, SqliteResultStore)
+        self.assertEqual(result_log.get_record_number(), 2)
+        self.assertEqual(result_log.get_info()["version"], __version__)
+        self.assertTrue(result_log.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+        [waiting_summary] = result_log.get_result_summaries_by_results(["Waiting"])
+        self.assertEqual(waiting_summary["status_string"], status_str)
+        result_log.update_result_summary_in_db(
+            result_summary={"result": "Failed"}, eids=[waiting_summary.eid])
+        self.assertEqual(
+            result_log.get_result_summaries_by_results(["Waiting"]), [])
+        result_log.remove_summaries_by_eids([waiting_summary.eid])
+        self.assertEqual(result_log.get_record_number(), 1)
+        self.assertEqual(len(result_log.get_result_summaries_by_status(tt_status)), 1)
+        self.assertIsInstance(json.dumps(result_log.dump_log()), str)
+
+    def test_session(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log(backend="sqlite")
+        with result_log.session():
+            result_log.save_result_summaries(deepcopy(summaries))
+            self.assertEqual(ResultLog(config.items).get_record_number(), 2)
+        self.assertEqual(ResultLog(config.items).get_record_number(), 4)
+        with self.assertRaises(RuntimeError):
+            with result_log.session():
+                result_log.remove_summaries_by_eids([1, 2, 3])
+                raise RuntimeError
+        self.assertEqual(result_log.get_record_number(), 4)
+
+    def test_dequeue_waiting(self):
+        assert_dequeue_waiting_in_order(self, backend="sqlite")
+
+    def test_compact_log(self):
+        assert_compact_log(self, backend="sqlite")
+
+    def test_result_counters(self):
+        assert_result_counters(self, backend="sqlite")
+
+    def test_iter_log(self):
+        assert_iter_log(self, backend="sqlite")
+
+    def test_migrate_from_tinydb(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log()
+        eids = [a_summary.eid for a_summary in result_log.dump_log()]
+        db_file = config.items["result log"]["db_file"]
+        config.items["result log"]["backend"] = "sqlite"
+        sqlite_log = ResultLog(config.items)
+        self.assertTrue(SqliteResultStore.is_sqlite_file(db_file))
+        self.assertTrue(os.path.exists(db_file + ".tinydb"))
+        self.assertEqual([a_summary.eid for a_summary in sqlite_log.dump_log()],
+                         eids)
+        self.assertTrue(sqlite_log.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+        self.assertEqual(sqlite_log.get_info()["application"], "dontwi")
+        journal_mode = sqlite_log.store.connection.execute(
+            "PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(journal_mode, "wal")
+
+
+class TestJournalStatusLog(unittest.TestCase):
+
+    def setUp(self):
         pass
 
+    def tearDown(self):
+        remove_dummy_files()
+
+    def test_has_result_of_status(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log(backend="journal")
+        self.assertIsInstance(result_log.store, JournalResultStore)
+        [waiting_summary] = result_log.get_result_summaries_by_results(["Waiting"])
+        result_log.update_result_summary_in_db(
+            result_summary={"result": "Start"}, eids=[waiting_summary.eid])
+        result_log.remove_summaries_by_eids([1])
+        result_log2 = ResultLog(config.items)
+        self.assertEqual(result_log2.get_record_number(), 1)
+        self.assertFalse(result_log2.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+        [start_summary] = result_log2.get_result_summaries_by_results(["Start"])
+        self.assertEqual(start_summary.eid, waiting_summary.eid)
+        self.assertEqual(result_log2.get_info()["version"], __version__)
+
+    def test_dequeue_waiting(self):
+        assert_dequeue_waiting_in_order(self, backend="journal")
+
+    def test_torn_last_line(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log(backend="journal")
+        db_file = config.items["result log"]["db_file"]
+        with open(db_file, "ab") as journal_file:
+            journal_file.write(b'{"op": "remove", "ei')
+        result_log2 = ResultLog(config.items)
+        self.assertEqual(result_log2.get_record_number(), 2)
+        result_log2.remove_summaries_by_eids([1])
+        self.assertEqual(ResultLog(config.items).get_record_number(), 1)
+
+    def test_compact_log(self):
+        assert_compact_log(self, backend="journal")
+
+    def test_result_counters(self):
+        assert_result_counters(self, backend="journal")
+
+    def test_iter_log(self):
+        assert_iter_log(self, backend="journal")
+
+    def test_snapshot(self):
+        config = make_loaded_dummy_config(backend="journal")
+        config.items["result log"]["snapshot_interval"] = "5"
+        db_file = config.items["result log"]["db_file"]
+        hashtag, tt_status, tw_status = get_dummy_materials()
+        result_log = ResultLog(config.items)
+        for a_id in range(12):
+            tt_status.status["id"] = str(a_id)
+            result_log.save_result_summaries([make_result_summary(
+                result_log=result_log, inbound_status=tt_status,
+                outbound_status=tw_status, status_string="", hashtag=hashtag,
+                result="Succeed")])
+        self.assertTrue(os.path.exists(db_file + ".snapshot"))
+        with open(db_file, "rb") as journal_file:
+            self.assertLess(len(journal_file.readlines()), 5)
+        result_log2 = ResultLog(config.items)
+        self.assertEqual(result_log2.get_record_number(), 12)
+        self.assertTrue(result_log2.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+
+    def test_session(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log(backend="journal")
+        with self.assertRaises(RuntimeError):
+            with result_log.session():
+                result_log.remove_summaries_by_eids([1, 2])
+                self.assertEqual(result_log.get_record_number(), 0)
+                raise RuntimeError
+        self.assertEqual(result_log.get_record_number(), 2)
+        other_log = ResultLog(config.items)
+        other_log.remove_summaries_by_eids([1])
+        self.assertEqual(result_log.get_record_number(), 1)
+
+    def test_migrate_from_tinydb(self):
+        config, hashtag, tt_status, tw_status,\
+            status_pr, result_log, status_str,\
+            summaries = make_dummy_conf_and_result_log()
+        eids = [a_summary.eid for a_summary in result_log.dump_log()]
+        db_file = config.items["result log"]["db_file"]
+        config.items["result log"]["backend"] = "journal"
+        journal_log = ResultLog(config.items)
+        self.assertTrue(os.path.exists(db_file + ".tinydb"))
+        self.assertEqual([a_summary.eid for a_summary in journal_log.dump_log()],
+                         eids)
+        self.assertTrue(journal_log.has_result_of_status(
+            status=tt_status, results=["Succeed"]))
+        journal_log.save_result_summaries([{"result": "Test"}])
+        self.assertEqual(journal_log.get_record_number(), 3)
+        self.assertEqual(ResultLog(config.items).get_record_number(), 3)
+
+
+def assert_dequeue_waiting_in_order(test_case, backend):
+    config, hashtag, tt_status, tw_status,\
+        status_pr, result_log, status_str,\
+        summaries = make_dummy_conf_and_result_log(backend=backend)
+    waiting_summaries = []
+    for a_id in ["1345241", "999", "1345231"]:
+        tt_status.status["id"] = a_id
+        summary = result_log.make_result_and_others_summary(
+            status_string=status_str, hashtag=hashtag, result="Waiting")
+        summary.update(result_log.make_status_summary("inbound", tt_status))
+        waiting_summaries.append(summary)
+    result_log.save_result_summaries(waiting_summaries)
+    test_case.assertEqual(result_log.peek_waiting()["inbound_status_id"], "999")
+    dequeued_ids = []
+    while True:
+        summary = result_log.dequeue_waiting()
+        if summary is None:
+            break
+        test_case.assertEqual(summary["result"], "Start")
+        dequeued_ids.append(summary["inbound_status_id"])
+    test_case.assertEqual(dequeued_ids,
+                          ["999", "1345221", "1345231", "1345241"])
+    test_case.assertEqual(
+        len(ResultLog(config.items).get_result_summaries_by_results(["Start"])), 4)
+
+
+def assert_compact_log(test_case, backend):
+    config, hashtag, tt_status, tw_status,\
+        status_pr, result_log, status_str,\
+        summaries = make_dummy_conf_and_result_log(backend=backend)
+    [succeed_summary] = result_log.get_result_summaries_by_results(["Succeed"])
+    result_log.update_result_summary_in_db(
+        result_summary={"processed_at": "2018-02-17T14:04:05.826111+00:00"},
+        eids=[succeed_summary.eid])
+    result_log.save_result_summaries([
+        result_log.make_result_and_others_summary(
+            status_string=status_str, hashtag=hashtag, result="Test")])
+    archive_dir = "_dontwi_archive"
+    test_case.assertEqual(result_log.compact_log(
+        retain_days=30, archive_dir=archive_dir), 1)
+    test_case.assertEqual(result_log.compact_log(
+        retain_days=30, archive_dir=archive_dir), 0)
+    result_log2 = ResultLog(config.items)
+    test_case.assertEqual(result_log2.get_record_number(), 2)
+    test_case.assertEqual(
+        result_log2.get_result_summaries_by_results(["Succeed"]), [])
+    test_case.assertTrue(result_log2.has_result_of_status(
+        status=tt_status, results=["Succeed"]))
+    test_case.assertEqual(result_log2.filter_unprocessed([tt_status]), [])
+    archive_name = os.path.join(archive_dir, "_dontwi_log.db-2018-02.jsonl.gz")
+    with gzip.open(archive_name, "rt") as archive_file:
+        [archived_summary] = [json.loads(a_line) for a_line in archive_file]
+    test_case.assertEqual(archived_summary["eid"], succeed_summary.eid)
+    test_case.assertEqual(archived_summary["inbound_status_id"],
+                          tt_status.get_status_id())
+    test_case.assertIsNotNone(
+        result_log2.store.get_info_item('name', 'compaction'))
+    test_case.assertEqual(result_log2.compact_log_if_due(), 0)
+
+
+def assert_result_counters(test_case, backend):
+    config, hashtag, tt_status, tw_status,\
+        status_pr, result_log, status_str,\
+        summaries = make_dummy_conf_and_result_log(backend=backend)
+    counters = result_log.get_result_counters()
+    test_case.assertEqual(sorted(counters), ["Succeed", "Waiting"])
+    test_case.assertEqual(counters["Succeed"]["count"], 1)
+    test_case.assertEqual(counters["Succeed"]["first_processed_at"],
+                          summaries[0]["processed_at"])
+    start_summary = result_log.dequeue_waiting()
+    counters = result_log.get_result_counters()
+    test_case.assertEqual(sorted(counters), ["Start", "Succeed"])
+    test_case.assertEqual(counters["Start"]["last_processed_at"],
+                          start_summary["processed_at"])
+    result_log.update_result_summary_in_db(
+        {"result": "Succeed"}, eids=[start_summary.eid])
+    counters = ResultLog(config.items).get_result_counters()
+    test_case.assertEqual(list(counters), ["Succeed"])
+    test_case.assertEqual(counters["Succeed"]["count"], 2)
+    test_case.assertEqual(counters["Succeed"]["last_processed_at"],
+                          start_summary["processed_at"])
+    result_log.remove_summaries_by_eids([start_summary.eid])
+    counters = result_log.get_result_counters()
+    test_case.assertEqual(counters["Succeed"]["count"], 1)
+    test_case.assertEqual(counters["Succeed"]["last_processed_at"],
+                          summaries[0]["processed_at"])
+    test_case.assertEqual(result_log.verify_result_counters(), {})
+    result_log.store.set_info_item('name', 'result_counters', {
+        'results': {"Succeed": {"count": 5}, "Failed": {"count": 1}}})
+    test_case.assertEqual(result_log.verify_result_counters(),
+                          {"Succeed": (5, 1), "Failed": (1, 0)})
+    test_case.assertEqual(result_log.get_result_counters()["Succeed"]["count"], 1)
+
+
+def assert_iter_log(test_case, backend):
+    config, hashtag, tt_status, tw_status,\
+        status_pr, result_log, status_str,\
+        summaries = make_dummy_conf_and_result_log(backend=backend)
+    failed_summary = result_log.make_result_and_others_summary(
+        status_string=status_str, hashtag="other_hashtag", result="Failed")
+    failed_summary["processed_at"] = "2018-02-17T14:04:05.826111+00:00"
+    result_log.save_result_summaries([failed_summary])
+    test_case.assertEqual(
+        [a_summary.eid for a_summary in result_log.iter_log()], [1, 2, 3])
+    test_case.assertEqual(
+        [a_summary["result"] for a_summary
+         in result_log.iter_log(results=["Failed", "Waiting"])],
+        ["Waiting", "Failed"])
+    test_case.assertEqual(
+        [a_summary.eid for a_summary in result_log.iter_log(since="2018-03-01")],
+        [1, 2])
+    test_case.assertEqual(
+        [a_summary.eid for a_summary in result_log.iter_log(
+            since="2018-02-17", until="2018-02-17T23:05:00+09:00")], [3])
+    test_case.assertEqual(
+        [a_summary.eid for a_summary in result_log.iter_log(
+            results=["Succeed", "Failed"], hashtag="#" + hashtag)], [1])
+
 
 def make_result_summary(result_log, inbound_status,
                         outbound_status, status_string, hashtag,
@@ -143,8 +568,8 @@ def get_dummy_materials():
     return h_tag, tt_status, tw_status
 
 
-def make_dummy_conf_and_result_log(your_mastodon_fqdn=None):
-    config = make_loaded_dummy_config(your_mastodon_fqdn)
+def make_dummy_conf_and_result_log(your_mastodon_fqdn=None, backend=None):
+    config = make_loaded_dummy_config(your_mastodon_fqdn, backend=backend)
     hashtag, tt_status, tw_status = get_dummy_materials()
     status_pr = StatusText(config.outbound)
     status_str = status_pr.make_tweet_string_from_toot(toot=tt_status, hashtag=hashtag)
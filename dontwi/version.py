@@ -2,4 +2,4 @@
 # -*- coding: utf-8 -*-
 """ Version number definition
 """
-__version__ = '1.1.1'
+__version__ = '1.2.0'
@@ -27,7 +27,7 @@ setup(
     license='GNU General Public License v3.0',
     packages=['dontwi'],
     install_requires=requirements,
-    extras_require={'systemd': ['systemd']},
+    extras_require={'systemd': ['systemd'], 'zstd': ['zstandard']},
     test_suite='dontwi.tests',
     entry_points={
         'console_scripts': [